@@ -420,9 +420,7 @@ def convert_examples_to_features(
 
 def write_tokens(tokens, det_tokens, mode, base_name):
     if mode == "test":
-        tmp_path = os.path.join('multi_ner', 'tmp')
-        if not os.path.exists(tmp_path):
-            os.makedirs(tmp_path)
+        os.makedirs(os.path.join('multi_ner', 'tmp'), exist_ok=True)
 
         path = os.path.join("multi_ner", "tmp",
                             "token_{}_{}.txt".format(mode, base_name))
@@ -522,7 +520,10 @@ class MTNER:
             self.params.model_name_or_path,
         )
         if self.params.use_remote_proxy:
-            self.model = TritonModelProxy(self.params.model_name_or_path.split("/")[-1], batch_size=self.params.batch_size)
+            self.model = TritonModelProxy(self.params.model_name_or_path.split("/")[-1],
+                                          batch_size=self.params.batch_size,
+                                          use_async_endpoint=getattr(self.params, 'use_async_endpoint', False),
+                                          use_batch_transform=getattr(self.params, 'use_batch_transform', False))
         else:
             self.model = RoBERTaMultiNER2.from_pretrained(
                 self.params.model_name_or_path,
@@ -720,10 +721,16 @@ class MTNER:
 
     def _predict(self, test_dataset: Dataset):
         sampler = SequentialSampler(test_dataset)
+        batch_size = 32  # you can adjust evaluation batch size, we prefer using 32
+        if getattr(self.params, 'use_batch_transform', False):
+            # hand the whole dataset to the proxy in one call so everything
+            # lands in a single Batch Transform job (the proxy chunks it into
+            # JSONL records itself)
+            batch_size = max(1, len(test_dataset))
         data_loader = DataLoader(
             test_dataset,
             sampler=sampler,
-            batch_size=32,  # you can adjust evaluation batch size, we prefer using 32
+            batch_size=batch_size,
             collate_fn=default_data_collator,
             drop_last=False,
         )
@@ -810,8 +817,7 @@ class MTNER:
         prefix = self.params.model_name_or_path.replace(self.params.local_output + '/', '')
         model_files_s3_paths = s3.list_objects_v2(Bucket=self.params.s3_bucket, Prefix=prefix)['Contents']
         model_files_s3_paths = [x['Key'] for x in model_files_s3_paths]
-        if not os.path.exists(self.params.model_name_or_path):
-            os.makedirs(self.params.model_name_or_path)
+        os.makedirs(self.params.model_name_or_path, exist_ok=True)
 
         for model_file_s3_path in model_files_s3_paths:
             if 'model.bin' in model_file_s3_path and not self.params.download_model_bin_file:
@@ -36,7 +36,7 @@ def mtner_recognize(model, dict_path, base_name, mtner_home):
         )
 
     if res is None:
-        return None, 0
+        return None
 
     # num_filtered_species_per_doc = filter_entities(res)
     # for n_f_spcs in num_filtered_species_per_doc:
@@ -48,10 +48,14 @@ def mtner_recognize(model, dict_path, base_name, mtner_home):
     num_entities = count_entities(res)
 
     res[0]['num_entities'] = num_entities
-    # Write output str to a .PubTator format file
+    # Write output str to a .PubTator format file (the socket server hands
+    # results over by path) and also return it so in-process callers can skip
+    # the disk round-trip
     with open(output_mt_ner, 'w', encoding='utf-8') as f:
         json.dump(res, f)
 
+    return res
+
 
 def run_server(model, args):
     host = args.mtner_host
@@ -1,11 +1,14 @@
 import argparse
+import functools
 import hashlib
-import json
+import logging
 import os
 import random
+import re
 import string
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import bioregistry
 import numpy as np
@@ -17,6 +20,23 @@ from bern2.metrics import metrics
 from bern2.multi_ner.main import MTNER
 from bern2.multi_ner.ner_server import mtner_recognize
 
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def standardize_prefix(prefix: str) -> str:
+    # bioregistry lookups walk its full registry; the handful of distinct
+    # prefixes seen per corpus makes this ideal to memoize
+    normalized_prefix = bioregistry.normalize_prefix(prefix)
+    if normalized_prefix is not None:
+        prefix = normalized_prefix
+
+    preferred_prefix = bioregistry.get_preferred_prefix(prefix)
+    if preferred_prefix is not None:
+        prefix = preferred_prefix
+
+    return prefix
+
 
 def parse():
     argparser = argparse.ArgumentParser()
@@ -39,12 +59,16 @@ def parse():
     return args
 
 
-def append_text_to_pubtator(input_mtner: str, pmid: str, text: str):
-    # Write input str to a .PubTator format file
-    with open(input_mtner, 'a', encoding='utf-8') as f:
+# line breaks become zero-width non-joiners, other whitespace controls a space;
+# '\r\n' is collapsed to '\n' beforehand so it maps to a single replacement
+_CHAR_NORMALIZATION_TABLE = str.maketrans({'\n': '\u200c', '\t': ' ', '\xa0': ' ', '\x0b': ' ', '\x0c': ' '})
+
+
+def write_texts_to_pubtator(input_mtner: str, pmid_text_pairs: list):
+    # Write all (pmid, text) pairs to a .PubTator format file in one go
+    with open(input_mtner, 'w', encoding='utf-8') as f:
         # only abstract
-        f.write(f'{pmid}|t|\n')
-        f.write(f'{pmid}|a|{text}\n\n')
+        f.writelines(f'{pmid}|t|\n{pmid}|a|{text}\n\n' for pmid, text in pmid_text_pairs)
 
 
 class LocalBERN2():
@@ -61,7 +85,9 @@ class LocalBERN2():
                  s3_bucket='data-science-repository',
                  local_output='local_output',
                  use_remote_proxy=False,
-                 batch_size=4
+                 batch_size=4,
+                 use_batch_transform=False,
+                 use_async_endpoint=False
                  ):
 
         self.time_format = time_format
@@ -72,13 +98,14 @@ class LocalBERN2():
         self.local_output = local_output
         self.use_remote_proxy = use_remote_proxy
         self.batch_size = batch_size
+        self.use_batch_transform = use_batch_transform
+        self.use_async_endpoint = use_async_endpoint
 
-        print(datetime.now().strftime(self.time_format), 'BERN2 LOADING..')
+        logger.info('BERN2 LOADING..')
         random.seed(seed)
         np.random.seed(seed)
 
-        if not os.path.exists('./output'):
-            os.mkdir('output')
+        os.makedirs('output', exist_ok=True)
 
         # delete prev. version outputs
         if not keep_files:
@@ -89,12 +116,18 @@ class LocalBERN2():
 
         # FOR NER
         self.mtner_home = mtner_home
-        if not os.path.exists(self.mtner_home):
-            os.mkdir(self.mtner_home)
+        os.makedirs(os.path.join(self.mtner_home, 'input'), exist_ok=True)
+        os.makedirs(os.path.join(self.mtner_home, 'output'), exist_ok=True)
 
         self.max_word_len = max_word_len
+        # matches any space-delimited word longer than max_word_len
+        self.long_word_pattern = re.compile(r'[^ ]{%d,}' % (max_word_len + 1))
+
+        # built lazily on the first ner() call, then reused; thread-local so
+        # concurrent annotate_text calls don't share MTNER's per-call state
+        self._mt_ner_local = threading.local()
 
-        print(datetime.now().strftime(self.time_format), 'BERN2 LOADED..')
+        logger.info('BERN2 LOADED..')
 
     def annotate_text(self, list_of_texts: list):
         # TODO: Make this a pd.Series instead of a list
@@ -154,13 +187,7 @@ class LocalBERN2():
                     new_cuis.append(cui)
                     continue
 
-                normalized_prefix = bioregistry.normalize_prefix(prefix)
-                if normalized_prefix is not None:
-                    prefix = normalized_prefix
-
-                preferred_prefix = bioregistry.get_preferred_prefix(prefix)
-                if preferred_prefix is not None:
-                    prefix = preferred_prefix
+                prefix = standardize_prefix(prefix)
 
                 # to convert CVCL_J260 to cellosaurus:CVCL_J260
                 if prefix == 'cellosaurus':
@@ -173,56 +200,24 @@ class LocalBERN2():
         return output
 
     def preprocess_input(self, text, base_name):
-        if '\r\n' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a CRLF -> replace it w/ a space')
-            text = text.replace('\r\n', '\u200c')
-
-        if '\n' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a line break -> replace it w/ a space')
-            text = text.replace('\n', '\u200c')
-
-        if '\t' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a tab -> replace w/ a space')
-            text = text.replace('\t', ' ')
-
-        if '\xa0' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a \\xa0 -> replace w/ a space')
-            text = text.replace('\xa0', ' ')
-
-        if '\x0b' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a \\x0b -> replace w/ a space')
-            text = text.replace('\x0b', ' ')
-
-        if '\x0c' in text:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a \\x0c -> replace w/ a space')
-            text = text.replace('\x0c', ' ')
+        normalized = text.replace('\r\n', '\n').translate(_CHAR_NORMALIZATION_TABLE)
+        if normalized != text:
+            logger.info('[%s] Found line breaks/tabs/control chars -> replaced them', base_name)
+            text = normalized
 
         # remove non-ascii
         # text = text.encode("ascii", "ignore").decode()
 
-        found_too_long_words = 0
-        tokens = text.split(' ')
-        for idx, tk in enumerate(tokens):
-            if len(tk) > self.max_word_len:
-                tokens[idx] = tk[:self.max_word_len]
-                found_too_long_words += 1
+        truncated, found_too_long_words = self.long_word_pattern.subn(
+            lambda m: m.group(0)[:self.max_word_len], text)
         if found_too_long_words > 0:
-            print(datetime.now().strftime(self.time_format),
-                  f'[{base_name}] Found a too long word -> cut the suffix of the word')
-            text = ' '.join(tokens)
+            logger.info('[%s] Found a too long word -> cut the suffix of the word', base_name)
+            text = truncated
 
         return text
 
     def tag_entities(self, list_of_texts: list, base_name):
-        base_name = self.generate_base_name(list_of_texts[0])
-        print(datetime.now().strftime(self.time_format),
-              f'id: {base_name}')
+        logger.info('id: %s', base_name)
 
         pubtator_file = f'{base_name}.PubTator'
 
@@ -231,17 +226,13 @@ class LocalBERN2():
         output_mtner = os.path.join(self.mtner_home, 'output',
                                     f'{pubtator_file}.json')
 
-        if not os.path.exists(self.mtner_home + '/input'):
-            os.mkdir(self.mtner_home + '/input')
-        if not os.path.exists(self.mtner_home + '/output'):
-            os.mkdir(self.mtner_home + '/output')
-
+        pmid_text_pairs = []
         for i, text in enumerate(list_of_texts):
             if len(text) == 0:
                 text = "lorem ipsum dolor sit amet"
-                print(f'File #{i} is empty!')
-            pmid = self.generate_base_name(text)
-            append_text_to_pubtator(input_mtner, pmid, text)
+                logger.warning('File #%s is empty!', i)
+            pmid_text_pairs.append((self.generate_base_name(text), text))
+        write_texts_to_pubtator(input_mtner, pmid_text_pairs)
 
         ner_start_time = time.time()
         with metrics.timer(f"{os.getenv('RunEnv')}.temp_debug.inference.bern2.ner.duration"):
@@ -254,8 +245,7 @@ class LocalBERN2():
         num_entities = ner_result['num_entities']
 
         ner_elapse_time = time.time() - ner_start_time
-        print(datetime.now().strftime(self.time_format),
-              f'[{base_name}] ALL NER {ner_elapse_time} sec')
+        logger.info('[%s] ALL NER %s sec', base_name, ner_elapse_time)
 
         # Rule-based Normalization models
         # r_norm_start_time = time.time()
@@ -316,16 +306,16 @@ class LocalBERN2():
             for mention_idx, mention_dict in enumerate(entity_dict):
                 start = mention_dict['start']
                 end = mention_dict['end']
-                if "%d-%d" % (start, end) not in span2mentions:
-                    span2mentions["%d-%d" % (start, end)] = []
+                if (start, end) not in span2mentions:
+                    span2mentions[(start, end)] = []
 
-                span2mentions["%d-%d" % (start, end)].append({"type": entity_type,
-                                                              "CUI": mention_dict['id'],
-                                                              "check_CUI": 1 if mention_dict['id'] != 'CUI-less' else 0,
-                                                              "prob": tagged_docs[0]['prob'][entity_type][mention_idx][
-                                                                  1],
-                                                              "is_neural_normalized": mention_dict[
-                                                                  'is_neural_normalized']})
+                span2mentions[(start, end)].append({"type": entity_type,
+                                                    "CUI": mention_dict['id'],
+                                                    "check_CUI": 1 if mention_dict['id'] != 'CUI-less' else 0,
+                                                    "prob": tagged_docs[0]['prob'][entity_type][mention_idx][
+                                                        1],
+                                                    "is_neural_normalized": mention_dict[
+                                                        'is_neural_normalized']})
 
         for span in span2mentions.keys():
             # sort elements with CUI
@@ -337,8 +327,8 @@ class LocalBERN2():
                 start = mention_dict['start']
                 end = mention_dict['end']
 
-                if span2mentions["%d-%d" % (start, end)][0]['CUI'] == mention_dict['id'] and \
-                        span2mentions["%d-%d" % (start, end)][0]['type'] == entity_type:
+                if span2mentions[(start, end)][0]['CUI'] == mention_dict['id'] and \
+                        span2mentions[(start, end)][0]['type'] == entity_type:
                     update_list.append(mention_dict)
 
             tagged_docs[0]['entities'].update({entity_type: update_list})
@@ -350,44 +340,51 @@ class LocalBERN2():
 
     # generate id for temporary files
     def generate_base_name(self, text):
-        # add time.time() to avoid collision
-        base_name = hashlib.sha224((text + str(time.time())).encode('utf-8')).hexdigest()
+        # add time.time() to avoid collision; blake2b is much faster than
+        # sha224 and these ids only need uniqueness, not crypto strength
+        base_name = hashlib.blake2b((text + str(time.time())).encode('utf-8'), digest_size=16).hexdigest()
         return base_name
 
+    def _get_mt_ner_model(self):
+        # Loading MTNER (config, tokenizer and weights) is expensive; build it
+        # once per thread and reuse it across ner() calls.
+        if getattr(self._mt_ner_local, 'model', None) is None:
+            mt_ner_params = argparse.Namespace(seed=1,
+                                               max_seq_length=128,
+                                               mtner_home=None,
+                                               disease_only=True,
+                                               time_format="dmis-lab/bern2-ner",
+                                               model_name_or_path=self.ner_model_name_or_path,
+                                               load_model_manually=self.load_model_manually,
+                                               s3_bucket='data-science-repository',
+                                               local_output='local_output',
+                                               use_remote_proxy=self.use_remote_proxy,
+                                               batch_size=self.batch_size,
+                                               use_batch_transform=self.use_batch_transform,
+                                               use_async_endpoint=self.use_async_endpoint,
+                                               download_model_bin_file=self.download_model_bin_file)
+            with metrics.timer(f"{os.getenv('RunEnv')}.temp_debug.inference.bern2.initialize_mtner.duration"):
+                self._mt_ner_local.model = MTNER(mt_ner_params)
+        return self._mt_ner_local.model
+
     def ner(self, pubtator_file, output_mtner, base_name) -> dict:
         # Run neural model
         start_time = time.time()
-        mt_ner_params = argparse.Namespace(seed=1,
-                                           max_seq_length=128,
-                                           mtner_home=None,
-                                           disease_only=True,
-                                           time_format="dmis-lab/bern2-ner",
-                                           model_name_or_path=self.ner_model_name_or_path,
-                                           load_model_manually=self.load_model_manually,
-                                           s3_bucket='data-science-repository',
-                                           local_output='local_output',
-                                           use_remote_proxy=self.use_remote_proxy,
-                                           batch_size=self.batch_size,
-                                           download_model_bin_file=self.download_model_bin_file)
-        with metrics.timer(f"{os.getenv('RunEnv')}.temp_debug.inference.bern2.initialize_mtner.duration"):
-            mt_ner_model = MTNER(mt_ner_params)
+        mt_ner_model = self._get_mt_ner_model()
         base_name = pubtator_file.split('.')[0]
         # hotfix
         base_name = base_name.replace("\x00A", "")
 
         with metrics.timer(f"{os.getenv('RunEnv')}.temp_debug.inference.bern2.mtner_recognize.duration"):
-            mtner_recognize(mt_ner_model, pubtator_file, base_name, self.mtner_home)
+            tagged_docs = mtner_recognize(mt_ner_model, pubtator_file, base_name, self.mtner_home)
 
-        with open(output_mtner, 'r', encoding='utf-8') as f:
-            tagged_docs = json.load(f)
-
-        num_entities = tagged_docs[0]['num_entities']
         if tagged_docs is None:
             return None
+        num_entities = tagged_docs[0]['num_entities']
 
         mtner_elapse_time = time.time() - start_time
-        print(datetime.now().strftime(self.time_format),
-              f'[{base_name}] Multi-task NER {mtner_elapse_time} sec, #entities: {num_entities}')
+        logger.info('[%s] Multi-task NER %s sec, #entities: %s',
+                    base_name, mtner_elapse_time, num_entities)
 
         return {"mtner_elapse_time": mtner_elapse_time,
                 "tagged_docs": tagged_docs,
@@ -406,15 +403,48 @@ def delete_files(dirname):
         # print('Delete', f_path)
         os.remove(f_path)
         n_deleted += 1
-    print(dirname, n_deleted)
+    logger.info('%s %s', dirname, n_deleted)
+
+
+def _annotate_df(bern2, df: pd.DataFrame, text_col: str):
+    # With a remote proxy, annotate_text is dominated by endpoint round-trips,
+    # so rows are fanned out on threads; each worker thread lazily builds its
+    # own MTNER wrapper, which is cheap there (only the tokenizer is loaded).
+    # In local-model mode a worker-per-thread would load the full model up to
+    # 8 times and inference is CPU/GPU-bound anyway, so stay single-threaded.
+    max_workers = max(1, min(8, len(df))) if bern2.use_remote_proxy else 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(bern2.annotate_text, df[text_col]))
+    res_df = pd.DataFrame(results, index=df.index)
+    res_df = pd.merge(df, res_df, left_index=True, right_index=True, how='left')
+    return res_df
 
 
 def run_bern2_on_batch(df: pd.DataFrame, text_col: str = 'content'):
     bern2 = get_initialized_bern()
+    return _annotate_df(bern2, df, text_col)
+
+
+def run_bern2_on_batch_transform(df: pd.DataFrame, text_col: str = 'content'):
+    # Offline variant for bulk jobs: runs the NER model through a SageMaker
+    # Batch Transform job instead of point-wise invoke_endpoint calls.
+    # All rows' texts are flattened into one annotate_text call (MTNER feeds
+    # the proxy in a single pass in transform mode), so the whole DataFrame
+    # shares one transform job and one instance cold start rather than
+    # launching a job per row. Keep run_bern2_on_batch for
+    # interactive/small workloads.
+    bern2 = get_initialized_bern()
+    bern2.use_batch_transform = True
+
+    texts_per_row = [list(row_texts) for row_texts in df[text_col]]
+    flat_texts = [text for row_texts in texts_per_row for text in row_texts]
+    flat_results = bern2.annotate_text(flat_texts) if flat_texts else []
+
     results = []
-    for cur_text in df[text_col]:
-        temp = bern2.annotate_text(cur_text)
-        results.append(temp)
+    start = 0
+    for row_texts in texts_per_row:
+        results.append(flat_results[start:start + len(row_texts)])
+        start += len(row_texts)
     res_df = pd.DataFrame(results, index=df.index)
     res_df = pd.merge(df, res_df, left_index=True, right_index=True, how='left')
     return res_df